@@ -1,135 +1,269 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import total_ordering
 from os import fstat
+import os
 from pathlib import Path
-from typing import List, Optional, Set, TextIO, Tuple
+from typing import BinaryIO, List, Optional, Set, Tuple
+import locale
 import logging
 
+# Buffer size for reading log files. Text mode already read in 8 KiB blocks;
+# the gain of binary mode is exact byte offsets without text-mode tell()
+# cookies, the larger buffer only means fewer reads on long backlogs.
+READ_BUFFER_SIZE = 65536
+
 logger = logging.getLogger(__name__)
 
 
+def _line_length(raw: bytes) -> int:
+    """Returns the byte length of the first complete line in `raw`, or 0
+
+    Lines end in LF, CRLF or a lone CR, like universal newlines in text mode.
+    A trailing CR may still be followed by LF and does not complete a line yet.
+    """
+    cr = raw.find(b"\r")
+    if cr == -1:
+        return len(raw) if raw.endswith(b"\n") else 0
+    if cr + 1 == len(raw):
+        return 0
+    return cr + 2 if raw[cr + 1] == 0x0A else cr + 1
+
+
+def _translate_newlines(text: str) -> str:
+    """Translates CRLF and lone CR line endings to LF"""
+    if "\r" not in text:
+        return text
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+@total_ordering
+@dataclass(slots=True, eq=False)
 class Offset:
     """Data-class to store file-offsets"""
 
-    def __init__(self, counter, inode, offset):
-        self.counter = counter
-        self.inode = inode
-        self.offset = offset
+    counter: int
+    inode: int
+    offset: int
+
+    # Offsets are ordered by (counter, offset), the inode is only informational
 
     def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
         return self.counter == other.counter and self.offset == other.offset
 
     def __lt__(self, other):
-        return self.counter < other.counter or (
-            self.counter == other.counter and self.offset < other.offset
-        )
-
-    def __le__(self, other):
-        return self.__lt__(other) or self.__eq__(other)
-
-    def __gt__(self, other):
-        return not self.__le__(other)
-
-    def __ge__(self, other):
-        return not self.__le__(other) or self.__eq__(other)
-
-    def __repr__(self):
-        return "Offset(counter=%d, inode=%d, offset=%d)" % (
-            self.counter,
-            self.inode,
-            self.offset,
-        )
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        if self.counter != other.counter:
+            return self.counter < other.counter
+        return self.offset < other.offset
 
 
 class Dogtail:
-    _fh: Optional[TextIO]
+    _fh: Optional[BinaryIO]
 
     def __init__(self, logfile_candidates: List[Path], offset_path: Path):
-        self._logfile_candidates = logfile_candidates
+        # Set before anything can fail, `__del__` relies on them
+        self._fh = None
+        self._offset_fd = None
+
+        # Resolve the paths once instead of on every reopen
+        self._logfile_candidates = tuple(os.fspath(p) for p in logfile_candidates)
+        self._primary_logfile = self._logfile_candidates[0]
         self._offset_file = offset_path
+        # Decode like open() in text mode would
+        self._encoding = locale.getpreferredencoding(False)
 
-        self._fh = None
+        self._fh_inode = None
         self.current_inode = None
         self.curr_offset = None
 
+        # Offset recorded by `update_offset_file` but not yet written
+        self._pending_offset = None
+        self._pending_updates = 0
+        self._flush_every = None
+
         self._counter = 1
-        if self._offset_file.exists() and self._offset_file.stat().st_size:
-            with open(self._offset_file) as f:
-                inode, offset = [int(line.strip()) for line in f]
-                logger.debug(f"Read offset: {inode=} {offset=}")
-                self._open_known_file(inode, offset)
+        # Set once all candidate files have been read to the end
+        self._exhausted = False
+        if (stored := self._read_offset_file()) is not None:
+            inode, offset = stored
+            logger.debug("Read offset: inode=%r offset=%r", inode, offset)
+            self._open_known_file(inode, offset)
+
+    def _read_offset_file(self) -> Optional[Tuple[int, int]]:
+        try:
+            data = self._offset_file.read_bytes()
+        except FileNotFoundError:
+            return None
+        if not data:
+            return None
+
+        try:
+            inode, offset = data.split(b"\n", 2)[:2]
+            return int(inode), int(offset)
+        except ValueError:
+            logger.warning("Ignoring malformed offset file data=%r", data)
+            return None
 
     def __iter__(self):
         return self
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
     @property
-    def filehandle(self) -> Optional[TextIO]:
+    def filehandle(self) -> Optional[BinaryIO]:
         if self._fh is None:
             self._open()
 
         return self._fh
 
-    def _get_next_line(self) -> Tuple[str, Offset]:
+    def _get_next_line(self) -> Optional[Tuple[str, Offset]]:
+        """Returns the next complete line and its offset, or None at EOF"""
         if self.filehandle is None or self.filehandle.closed:
-            raise StopIteration
+            return None
 
-        curr_offset = self.filehandle.tell()
-        fh_inode = fstat(self.filehandle.fileno()).st_ino
-        line = self.filehandle.readline()
+        # `curr_offset` always matches the position of the open file
+        curr_offset = self.curr_offset
+        raw = self.filehandle.readline()
+        length = _line_length(raw)
 
-        if not line.endswith("\n"):
-            self.filehandle.seek(curr_offset)
-            raise StopIteration
-        if not line:
-            raise StopIteration
+        if length < len(raw):
+            # Leave a partial line, or whatever follows a lone "\r", for the
+            # next read
+            self.filehandle.seek(curr_offset + length)
+        if not length:
+            return None
+
+        self.curr_offset = curr_offset + length
+        self.current_inode = self._fh_inode
 
-        self.curr_offset = self.filehandle.tell()
-        self.current_inode = fstat(self.filehandle.fileno()).st_ino
+        line = _translate_newlines(
+            str(memoryview(raw)[:length], self._encoding, "backslashreplace")
+        )
 
-        return line, Offset(counter=self._counter, inode=fh_inode, offset=curr_offset)
+        return line, Offset(
+            counter=self._counter, inode=self._fh_inode, offset=curr_offset
+        )
+
+    def _read_remaining(self) -> str:
+        """Reads all complete lines left in the current file at once"""
+        if self.filehandle is None or self.filehandle.closed:
+            return ""
+
+        curr_offset = self.curr_offset
+        data = self.filehandle.read()
+
+        # Leave a trailing partial line for the next read, a final "\r" may
+        # still be followed by "\n"
+        end = max(data.rfind(b"\n"), data.rfind(b"\r", 0, len(data) - 1)) + 1
+        if end < len(data):
+            self.filehandle.seek(curr_offset + end)
+        if end:
+            self.curr_offset = curr_offset + end
+            self.current_inode = self._fh_inode
+
+        # Decode through a memoryview to avoid copying the data once more
+        return _translate_newlines(
+            str(memoryview(data)[:end], self._encoding, "backslashreplace")
+        )
 
     def _close(self):
-        logger.debug(f"Closing {self._fh=}")
+        logger.debug("Closing self._fh=%r", self._fh)
         if not self._fh:
             return
 
         self._fh.close()
         self._fh = None
+        self._fh_inode = None
 
-    def _try_open(self, path) -> Optional[TextIO]:
+    def close(self):
+        """Closes the current log file and the offset file
+
+        The offset file is kept open between writes. If it is deleted or
+        replaced by someone else meanwhile, later writes still go to the old
+        file until `close` is called, and nothing reports this.
+        """
+        self._close()
+        if self._offset_fd is not None:
+            os.close(self._offset_fd)
+            self._offset_fd = None
+
+    def _try_open(self, path) -> Optional[BinaryIO]:
         try:
-            return open(path, "r", 1, errors="backslashreplace")
+            # Binary mode makes line lengths byte counts, so offsets can be
+            # tracked without tell(). Lines are decoded after reading.
+            fh = open(path, "rb", buffering=READ_BUFFER_SIZE)
         except OSError as e:
-            logger.debug(f"Failed to open {e=}")
+            logger.debug("Failed to open e=%r", e)
+            return None
+
+        if hasattr(os, "posix_fadvise"):
+            # Logs are read front to back, let the kernel read ahead further.
+            # This is only a hint, failing to give it must not fail the open.
+            try:
+                os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError as e:
+                logger.debug("Failed to advise sequential access e=%r", e)
+        return fh
 
     def _open_known_file(self, inode, offset):
-        logger.debug(f"Finding {inode=} in {self._logfile_candidates}")
+        logger.debug("Finding inode=%r in %s", inode, self._logfile_candidates)
         for filename in self._logfile_candidates:
-            logger.debug(f"Trying {filename=}")
+            logger.debug("Trying filename=%r", filename)
 
             if (fh := self._try_open(filename)) is not None:
                 fh_inode = fstat(fh.fileno()).st_ino
                 if inode == fh_inode:
                     fh.seek(offset)
                     self._fh = fh
+                    self._fh_inode = fh_inode
                     self.curr_offset = offset
                     self.current_inode = fh_inode
 
-                    logger.debug(f"Opened {self._fh=} at {offset=}")
+                    logger.debug("Opened self._fh=%r at offset=%r", self._fh, offset)
                     return
+                fh.close()
 
         else:
             logger.debug("No matching file found")
 
+    def _is_current_file(self, inode) -> bool:
+        # If the first file is also the file from the offset, we're done
+        if inode != self.current_inode:
+            return False
+        logger.debug("Primary log inode=%r is the current file", inode)
+        return True
+
     def _open_first_file(self):
-        if (fh := self._try_open(self._logfile_candidates[0])) is not None:
+        # Check the inode by path first, so an unrotated log isn't reopened
+        # on every EOF
+        try:
+            path_inode = os.stat(self._primary_logfile).st_ino
+        except OSError as e:
+            logger.debug("Failed to stat e=%r", e)
+            return
+        if self._is_current_file(path_inode):
+            return
+
+        if (fh := self._try_open(self._primary_logfile)) is not None:
+            # The file may have been rotated since the stat, trust the fd only
             fh_inode = fstat(fh.fileno()).st_ino
-            logging.info(f"{fh_inode=} {self.current_inode=}")
-            if (
-                fh_inode == self.current_inode
-            ):  # If the first file is also the file from the offset, we're done
-                logging.info("aborting")
+            if self._is_current_file(fh_inode):
+                fh.close()
                 return
             self._fh = fh
-            logger.debug(f"Opened {self._fh=}")
+            self._fh_inode = fh_inode
+            logger.debug("Opened self._fh=%r", self._fh)
             self._counter += 1
             self.curr_offset = 0
             self.current_inode = fh_inode
@@ -140,30 +274,102 @@ class Dogtail:
             self._open_first_file()
 
     def __next__(self) -> Tuple[str, Offset]:
-        try:
-            line = self._get_next_line()
+        if self._exhausted:
+            raise StopIteration
+
+        if (line := self._get_next_line()) is not None:
             return line
-        except StopIteration:
-            logger.debug("EOF")
-            # EOF. open next file if possible and continue, else stop iteration
-            # open up current logfile and continue
-            self._close()
-            line = self._get_next_line()
+
+        logger.debug("EOF")
+        # EOF. open next file if possible and continue, else stop iteration
+        # open up current logfile and continue
+        self._close()
+        if (line := self._get_next_line()) is not None:
             return line
+        self._mark_exhausted()
+        raise StopIteration
+
+    def _mark_exhausted(self):
+        # Only once the primary log has been opened `_open` never opens anything
+        # again. Before that it checks the primary path on every call, which is
+        # how a rotation of the file we resumed from is noticed.
+        self._exhausted = self._counter > 1
+
+    def _read_files(self):
+        """Yields the remaining lines of each file as one string per file
+
+        Moves between files the same way `__next__` does, but without building
+        an `Offset` for every line.
+        """
+        if self._exhausted:
+            return
+
+        yield self._read_remaining()
+        self._close()
+        yield self._read_remaining()
+        self._close()
+        self._mark_exhausted()
 
     def readlines(self):
-        return [line for line, _ in self]
+        return [
+            line + "\n" for data in self._read_files() for line in data.split("\n")[:-1]
+        ]
 
     def read(self):
-        return "".join(self.readlines())
+        return "".join(self._read_files())
+
+    def _write_offset(self, inode, offset):
+        # The offset file is only a few bytes, keep it open and overwrite it
+        # in place instead of reopening it for every update
+        if self._offset_fd is None:
+            self._offset_fd = os.open(
+                self._offset_file, os.O_WRONLY | os.O_CREAT, 0o644
+            )
+        data = f"{inode}\n{offset}\n".encode()
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._offset_fd, data, 0)
+        else:  # Not available on Windows
+            os.lseek(self._offset_fd, 0, os.SEEK_SET)
+            os.write(self._offset_fd, data)
+        os.ftruncate(self._offset_fd, len(data))
 
     def write_offset_to_file(self, offset):
         """Writes an `Offset` to the offset file"""
-        with open(self._offset_file, "w") as f:
-            f.write("%s\n%s\n" % (offset.inode, offset.offset))
-        logging.info(f"Wrote offset to file {offset=}")
+        self._write_offset(offset.inode, offset.offset)
+        logger.info("Wrote offset to file offset=%r", offset)
 
     def update_offset_file(self):
-        with open(self._offset_file, "w") as f:
-            f.write("%s\n%s\n" % (self.current_inode, self.curr_offset))
-        logging.info(f"Wrote offset to file {self.current_inode=} {self.curr_offset=}")
+        """Records the current offset and writes it to the offset file
+
+        Inside `batched_offsets` the write is deferred until enough updates
+        have accumulated. The offset file is kept open for later writes and
+        overwritten in place, so a file deleted or replaced by someone else is
+        not noticed before `close`.
+        """
+        self._pending_offset = (self.current_inode, self.curr_offset)
+        self._pending_updates += 1
+        if self._flush_every is None or self._pending_updates >= self._flush_every:
+            self.flush_offset()
+
+    def flush_offset(self):
+        """Writes the last offset recorded by `update_offset_file`, if any"""
+        if not self._pending_updates:
+            return
+
+        inode, offset = self._pending_offset
+        self._write_offset(inode, offset)
+        self._pending_updates = 0
+        logger.info("Wrote offset to file inode=%r offset=%r", inode, offset)
+
+    @contextmanager
+    def batched_offsets(self, flush_every=1000):
+        """Only write every `flush_every`-th `update_offset_file` call to disk
+
+        The last recorded offset is written when the block is left.
+        """
+        self._flush_every = flush_every
+        try:
+            yield self
+        finally:
+            self._flush_every = None
+            self.flush_offset()
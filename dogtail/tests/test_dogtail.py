@@ -1,9 +1,10 @@
+import dataclasses
 import os
 import shutil
 
 import pytest
 
-from dogtail import Dogtail
+from dogtail import Dogtail, Offset
 
 
 @pytest.fixture
@@ -176,3 +177,143 @@ def test_logrotate_race(dogtail, logfile, logfile_candidates, offset_path):
     with open(offset_path, "r") as f:
         inode, offset = int(next(f)), int(next(f))
     assert (inode, offset) in [(old_log_inode, 6), (new_log_inode, 0)]
+
+
+def test_offsets_are_byte_offsets(logpath, offset_path, logfile_candidates):
+    with open(logpath, "w", encoding="utf-8") as f:
+        f.write("ä\nö\n")
+
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    lines, offsets = list(zip(*dogtail))
+    assert lines == ("ä\n", "ö\n")
+    assert [o.offset for o in offsets] == [0, 3]
+    assert dogtail.curr_offset == 6
+
+
+def test_readlines_matches_iterator(logpath, logfile_candidates, offset_path):
+    """
+    Lines end at LF, CRLF and CR like in text mode, other line breaks recognised
+    by str.splitlines() are kept inside the line.
+    """
+    with open(logpath, "wb") as f:
+        f.write(b"1\r2\n3\x0c\n4\r\n")
+
+    expected = ["1\n", "2\n", "3\x0c\n", "4\n"]
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    assert [line for line, _ in dogtail] == expected
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    assert dogtail.readlines() == expected
+
+
+def test_batched_offsets(logfile, offset_path, logfile_candidates):
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+
+    with dogtail.batched_offsets(flush_every=2):
+        next(dogtail)
+        dogtail.update_offset_file()
+        assert not offset_path.exists()
+
+        next(dogtail)
+        dogtail.update_offset_file()
+        assert offset_path.read_text().split() == [str(dogtail.current_inode), "4"]
+
+        next(dogtail)
+        dogtail.update_offset_file()
+        assert offset_path.read_text().split()[1] == "4"
+
+    assert offset_path.read_text().split()[1] == "6"
+
+
+def test_malformed_offset_file(logfile_candidates, offset_path, test_str):
+    offset_path.write_text("garbage\n")
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    assert dogtail.read() == test_str
+
+
+def test_exhausted_iterator(dogtail, logfile, test_lines):
+    assert [line for line, _ in dogtail] == test_lines
+    append(logfile, "4\n")
+    assert not list(dogtail)
+    assert not dogtail.read()
+
+
+def test_rotation_after_read(logfile, logfile_candidates, offset_path, test_str):
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    dogtail.read()
+    dogtail.update_offset_file()
+
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    assert not dogtail.read()
+    logrotate(logfile)
+    append(logfile, "new\n")
+    assert dogtail.read() == "new\n"
+
+
+def test_read_before_logfile_exists(logpath, offset_path):
+    dogtail = Dogtail(logfile_candidates=(logpath,), offset_path=offset_path)
+    assert not dogtail.read()
+    append(logpath, "1\n")
+    assert dogtail.read() == "1\n"
+
+
+def test_offset_file_is_rewritten_in_place(logfile_candidates, offset_path):
+    with Dogtail(
+        logfile_candidates=logfile_candidates, offset_path=offset_path
+    ) as dogtail:
+        dogtail.write_offset_to_file(Offset(counter=1, inode=12345, offset=678))
+        dogtail.write_offset_to_file(Offset(counter=1, inode=1, offset=2))
+        assert offset_path.read_text() == "1\n2\n"
+
+    # Closing again is harmless, and writes after closing reopen the offset
+    # file instead of writing to a replaced one
+    dogtail.close()
+    offset_path.unlink()
+    offset_path.write_text("3\n4\n")
+    dogtail.write_offset_to_file(Offset(counter=1, inode=5, offset=6))
+    assert offset_path.read_text() == "5\n6\n"
+
+
+def test_universal_newlines(logpath, logfile_candidates, offset_path):
+    with open(logpath, "wb") as f:
+        f.write(b"a\r\nb\r\nc\rd\ne\r")
+
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    lines, offsets = list(zip(*dogtail))
+    assert lines == ("a\n", "b\n", "c\n", "d\n")
+    assert [o.offset for o in offsets] == [0, 3, 6, 8]
+    # A trailing CR may still become CRLF
+    assert dogtail.curr_offset == 10
+
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    assert dogtail.read() == "a\nb\nc\nd\n"
+    assert dogtail.curr_offset == 10
+
+
+def test_offset_fields():
+    offset = Offset(counter=1, inode=2, offset=3)
+    assert dataclasses.astuple(offset) == (1, 2, 3)
+    # Slotted for a small per-line footprint, but not frozen: frozen dataclasses
+    # are several times slower to construct
+    assert not hasattr(offset, "__dict__")
+    assert dataclasses.replace(offset, offset=4).offset == 4
+    assert offset == Offset(counter=1, inode=4, offset=3)
+    assert offset < Offset(counter=2, inode=2, offset=0)
+
+
+def test_offset_file_without_pwrite(monkeypatch, logfile_candidates, offset_path):
+    monkeypatch.delattr(os, "pwrite")
+    with Dogtail(
+        logfile_candidates=logfile_candidates, offset_path=offset_path
+    ) as dogtail:
+        dogtail.write_offset_to_file(Offset(counter=1, inode=12345, offset=678))
+        dogtail.write_offset_to_file(Offset(counter=1, inode=1, offset=2))
+        assert offset_path.read_text() == "1\n2\n"
+
+
+def test_locale_encoding(monkeypatch, logpath, logfile_candidates, offset_path):
+    monkeypatch.setattr("locale.getpreferredencoding", lambda do_setlocale: "latin-1")
+    with open(logpath, "wb") as f:
+        f.write("ä\n".encode("latin-1"))
+
+    dogtail = Dogtail(logfile_candidates=logfile_candidates, offset_path=offset_path)
+    assert dogtail.read() == "ä\n"